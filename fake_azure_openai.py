@@ -0,0 +1,358 @@
+"""
+Local stand-in for the Azure OpenAI chat-completions API, for benchmarking the
+agent pipeline with no network.
+
+Every POST to .../chat/completions (e.g. /openai/deployments/gpt-4.1/chat/completions)
+is assigned a route from the prompt content: classifier, patient, evaluator or
+agent (the genie semantic parser and response generator). Each route has its
+own lognormal latency, 429/500 injection rates and optional scripted replies.
+Responses carry simulated token usage and x-ratelimit-* headers from a
+per-minute request/token budget; going over the budget returns a 429 with
+Retry-After, like the real service. Prompt prefixes seen before are reported
+as cached_tokens in 128-token blocks once a prompt reaches 1024 tokens, like
+the provider's prefix cache. GET /stats returns per-route counts and latency
+percentiles.
+
+Point the agent at it by overriding the credentials from env_setting.py:
+
+    python fake_azure_openai.py --port 8900 [--config fake_azure_openai.json]
+    LLM_API_ENDPOINT=http://127.0.0.1:8900 LLM_API_KEY=fake LLM_API_VERSION=2024-10-21 python heart_failure_agent.py
+
+The --config JSON file overrides any part of DEFAULT_CONFIG, e.g.
+{"routes": {"classifier": {"latency_median_ms": 800, "error_rate_429": 0.05}}}.
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+import hashlib
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_ROUTE = {
+    "latency_median_ms": 400,
+    "latency_sigma": 0.5,
+    "error_rate_429": 0.0,
+    "error_rate_500": 0.0,
+    "replies": [],
+}
+
+DEFAULT_CONFIG = {
+    "requests_per_minute": 600,
+    "tokens_per_minute": 500000,
+    "prefix_cache_min_tokens": 1024,
+    "prefix_cache_block_tokens": 128,
+    "prefix_cache_entries": 10000,
+    "routes": {
+        "classifier": {"latency_median_ms": 300},
+        "patient": {
+            "latency_median_ms": 600,
+            "replies": [
+                "Hi, I'm here for my medication check.",
+                "I'm taking lisinopril 10 mg once a day.",
+                "My blood pressure is 120 over 80 and my heart rate is 72.",
+                "My potassium was 4.5 and my eGFR was 60.",
+                "I haven't noticed any side effects.",
+            ],
+            # After this many patient turns the patient says exit
+            "turns_before_exit": 8,
+        },
+        "evaluator": {"latency_median_ms": 2500, "score": 4},
+        "agent": {
+            "latency_median_ms": 700,
+            "replies": ["Thank you. Could you tell me more about how you have been feeling?"],
+        },
+    },
+}
+
+SYMPTOM_TERMS = {
+    "angioedema": ["angioedema", "swollen lips", "swollen tongue", "throat swelling", "face swelling"],
+    "bronchospasm": ["bronchospasm", "wheez", "can't breathe", "shortness of breath", "trouble breathing"],
+    "adhf": ["disoriented", "where am i", "confus", "altered mental", "memory loss"],
+    "gynecomastia": ["gynecomastia", "breast"],
+}
+
+EVALUATION_METRICS = [
+    "information_gathering_completeness",
+    "missing_data_handling",
+    "recommendation_success",
+    "safety_and_clinical",
+    "conversation_fluidity",
+    "confusion_handling",
+    "overall_effectiveness",
+]
+
+
+def merge_config(base, override):
+    merged = dict(base)
+    for key, value in override.items():
+        merged[key] = merge_config(base[key], value) if isinstance(value, dict) and isinstance(base.get(key), dict) else value
+    return merged
+
+
+def count_tokens(text):
+    """Rough tokenizer stand-in: about four characters per token."""
+    return max(1, math.ceil(len(text) / 4))
+
+
+def message_text(message):
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+
+def detect_route(messages):
+    text = " ".join(message_text(message) for message in messages)
+    if "You are a medical symptom classifier" in text:
+        return "classifier"
+    if "You are an expert evaluator assessing a heart failure" in text:
+        return "evaluator"
+    if messages and messages[0].get("role") == "system" and "medication titration agent" in message_text(messages[0]):
+        return "patient"
+    return "agent"
+
+
+def classify_symptoms(text, labels):
+    text = text.lower()
+    return {label: any(term in text for term in SYMPTOM_TERMS.get(label, [])) for label in labels}
+
+
+def classifier_reply(body):
+    user_text = message_text(body["messages"][-1])
+    schema = body.get("response_format", {}).get("json_schema", {}).get("schema", {})
+    properties = schema.get("properties", {})
+    if "verdicts" in properties:
+        labels = [name for name in properties["verdicts"]["items"]["properties"] if name != "patient"]
+        verdicts = []
+        for match in re.finditer(r"^Patient (\d+) \(sex: ([^)]*)\): (.*)$", user_text, re.M):
+            verdicts.append({"patient": int(match.group(1)), **classify_symptoms(match.group(3), labels)})
+        return json.dumps({"verdicts": verdicts})
+    labels = list(properties) or list(SYMPTOM_TERMS)
+    return json.dumps(classify_symptoms(user_text.split("Patient symptoms:")[-1], labels))
+
+
+def evaluator_reply(route_config):
+    score = route_config.get("score", 4)
+    evaluation = {"conversation_completed": True, "critical_data_missing": False, "emergency_present": False}
+    for metric in EVALUATION_METRICS:
+        evaluation[metric] = {"score": score, "reasoning": "Simulated evaluation."}
+    return json.dumps(evaluation, indent=2)
+
+
+def scripted_reply(route, route_config, body, turn):
+    replies = route_config.get("replies") or ["OK."]
+    if route == "patient":
+        patient_turns = sum(1 for message in body["messages"] if message.get("role") == "assistant")
+        if patient_turns >= route_config.get("turns_before_exit", 8):
+            return "Thank you, exit"
+        return replies[patient_turns % len(replies)]
+    return replies[turn % len(replies)]
+
+
+class FakeAzureOpenAI:
+    """Shared state of the fake endpoint: configuration, rate-limit budget and statistics."""
+
+    def __init__(self, config, seed=None):
+        self.config = config
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.window_requests = 0
+        self.window_tokens = 0
+        self.turns = {}
+        self.latencies = {}
+        self.statuses = {}
+        self.prefixes = OrderedDict()
+
+    def route_config(self, route):
+        return merge_config(DEFAULT_ROUTE, self.config["routes"].get(route, {}))
+
+    def reserve(self, tokens):
+        """Spend the per-minute budget; return (allowed, remaining requests, remaining tokens, reset seconds)."""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 60:
+                self.window_start = now
+                self.window_requests = 0
+                self.window_tokens = 0
+            reset = 60 - (now - self.window_start)
+            allowed = (
+                self.window_requests + 1 <= self.config["requests_per_minute"]
+                and self.window_tokens + tokens <= self.config["tokens_per_minute"]
+            )
+            if allowed:
+                self.window_requests += 1
+                self.window_tokens += tokens
+            return (
+                allowed,
+                self.config["requests_per_minute"] - self.window_requests,
+                self.config["tokens_per_minute"] - self.window_tokens,
+                reset,
+            )
+
+    def cached_prefix_tokens(self, prompt_text, prompt_tokens):
+        """Tokens of the longest block-aligned prefix seen before; remembers this prompt's prefixes."""
+        minimum = self.config["prefix_cache_min_tokens"]
+        block = self.config["prefix_cache_block_tokens"]
+        cached = 0
+        with self.lock:
+            for tokens in range(minimum, prompt_tokens + 1, block):
+                digest = hashlib.sha256(prompt_text[:tokens * 4].encode("utf-8")).hexdigest()
+                if digest in self.prefixes:
+                    self.prefixes.move_to_end(digest)
+                    cached = tokens
+                else:
+                    self.prefixes[digest] = True
+            while len(self.prefixes) > self.config["prefix_cache_entries"]:
+                self.prefixes.popitem(last=False)
+        return cached
+
+    def sample(self, route_config):
+        """Draw (latency seconds, injected status or None) for one request."""
+        with self.lock:
+            latency = self.random.lognormvariate(math.log(route_config["latency_median_ms"] / 1000), route_config["latency_sigma"])
+            draw = self.random.random()
+        if draw < route_config["error_rate_429"]:
+            return latency, 429
+        if draw < route_config["error_rate_429"] + route_config["error_rate_500"]:
+            return latency, 500
+        return latency, None
+
+    def next_turn(self, route):
+        with self.lock:
+            turn = self.turns.get(route, 0)
+            self.turns[route] = turn + 1
+            return turn
+
+    def record(self, route, status, latency):
+        with self.lock:
+            self.latencies.setdefault(route, []).append(latency)
+            self.statuses.setdefault(route, {}).setdefault(str(status), 0)
+            self.statuses[route][str(status)] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for route, latencies in self.latencies.items():
+                ordered = sorted(latencies)
+                stats[route] = {
+                    "requests": len(ordered),
+                    "statuses": self.statuses[route],
+                    **{f"p{q}_ms": round(ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))] * 1000, 1) for q in (50, 90, 99)},
+                }
+            return stats
+
+    def complete(self, body):
+        """Return (status, headers, payload) for one chat-completions request."""
+        started = time.monotonic()
+        messages = body.get("messages", [])
+        route = detect_route(messages)
+        route_config = self.route_config(route)
+        prompt_tokens = sum(count_tokens(message_text(message)) for message in messages)
+        latency, injected = self.sample(route_config)
+        allowed, remaining_requests, remaining_tokens, reset = self.reserve(prompt_tokens + body.get("max_tokens", 0) // 4)
+        headers = {
+            "x-ratelimit-limit-requests": str(self.config["requests_per_minute"]),
+            "x-ratelimit-limit-tokens": str(self.config["tokens_per_minute"]),
+            "x-ratelimit-remaining-requests": str(max(0, remaining_requests)),
+            "x-ratelimit-remaining-tokens": str(max(0, remaining_tokens)),
+            "x-ratelimit-reset-requests": f"{reset:.1f}s",
+            "x-fake-route": route,
+        }
+
+        if not allowed or injected == 429:
+            time.sleep(min(latency, 0.05))
+            headers["retry-after"] = str(max(1, math.ceil(reset if not allowed else 1)))
+            self.record(route, 429, time.monotonic() - started)
+            return 429, headers, {"error": {"code": "429", "message": "Requests to the ChatCompletions_Create Operation have exceeded the rate limit (simulated)."}}
+        time.sleep(latency)
+        if injected == 500:
+            self.record(route, 500, time.monotonic() - started)
+            return 500, headers, {"error": {"code": "InternalServerError", "message": "The server had an error while processing your request (simulated)."}}
+
+        if route == "classifier":
+            content = classifier_reply(body)
+        elif route == "evaluator":
+            content = evaluator_reply(route_config)
+        else:
+            content = scripted_reply(route, route_config, body, self.next_turn(route))
+        completion_tokens = count_tokens(content)
+        prompt_text = "".join(f"{message.get('role')}:{message_text(message)}" for message in messages)
+        cached_tokens = self.cached_prefix_tokens(prompt_text, prompt_tokens)
+        self.record(route, 200, time.monotonic() - started)
+        return 200, headers, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4.1"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            },
+        }
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def send_json(self, status, payload, headers=None):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/stats":
+                self.send_json(200, fake.stats())
+            else:
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not self.path.split("?")[0].endswith("/chat/completions"):
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                return
+            status, headers, payload = fake.complete(body)
+            self.send_json(status, payload, headers)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--config", help="JSON file merged over DEFAULT_CONFIG")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config = DEFAULT_CONFIG
+    if args.config:
+        with open(args.config, "r", encoding="utf-8") as f:
+            config = merge_config(DEFAULT_CONFIG, json.load(f))
+
+    fake = FakeAzureOpenAI(config, args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(fake))
+    print(f"Fake Azure OpenAI listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(fake.stats(), indent=2))
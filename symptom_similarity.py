@@ -0,0 +1,316 @@
+"""
+Near-duplicate matching of patient symptom answers.
+
+heart_failure_agent.py uses SemanticVerdictCache (SEMANTIC_CACHE=1) to reuse a
+contraindication verdict for a paraphrased answer. Two answers may share a
+verdict only when they negate exactly the same terms and their embeddings are
+at least the threshold apart; see CALIBRATION_PAIRS for how the default
+threshold was chosen. Everything here is pure Python + numpy so it can be
+imported (and tested) without the agent runtime.
+"""
+import json
+import random
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+# Negation cues. The agent's keyword triage also uses this to refuse positive
+# matches in negated answers ("no swollen lips").
+negation_pattern = re.compile(r"\b(no|not|never|without|denies|deny|nothing)\b|n't\b")
+
+# Words that carry no symptom meaning; dropping them lets "lips are swollen"
+# and "my lips swelled up" reduce to the same terms.
+STOPWORDS = {
+    "i", "i'm", "im", "i've", "ive", "me", "my", "mine", "myself", "am", "is", "are", "was", "were", "be", "been",
+    "being", "have", "has", "had", "having", "do", "does", "did", "a", "an", "the", "and", "or", "of", "in", "on",
+    "at", "to", "up", "it", "its", "it's", "this", "that", "some", "bit", "little", "kind", "sort", "really", "very",
+    "quite", "just", "so", "like", "get", "got", "getting", "been", "lately", "recently", "today", "also", "too",
+    "any", "all", "both", "there", "experiencing", "experience", "feel", "feeling", "felt", "notice", "noticed",
+    "noticing", "seem", "seems", "when", "while", "with", "around", "what", "which", "since",
+}
+
+# Irregular forms the suffix rules below cannot reduce.
+LEMMAS = {
+    "swollen": "swell", "puffy": "puff", "puffed": "puff", "breathless": "breath", "breathe": "breath",
+    "breathing": "breath", "wheezy": "wheez", "short": "short", "shortness": "short", "confused": "confus",
+    "confusion": "confus", "dizzy": "dizz", "dizziness": "dizz", "tender": "tender", "tenderness": "tender",
+}
+
+CLAUSE_BREAKS = {"but", "although", "though", "however", "except", "yet"}
+NEGATION_SCOPE = 4
+
+
+def stem(word):
+    """Reduce a word to a crude stem: irregular lemmas first, then common suffixes."""
+    word = word.strip("'")
+    if word in LEMMAS:
+        return LEMMAS[word]
+    for suffix, replacement in (("iness", ""), ("ness", ""), ("ing", ""), ("ied", "y"), ("ies", "y"), ("ed", ""), ("es", ""), ("s", "")):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:len(word) - len(suffix)] + replacement
+            break
+    return LEMMAS.get(word, word)
+
+
+def tokenize(text):
+    """Split on clause punctuation as well as whitespace; punctuation ends a negation's scope."""
+    return re.findall(r"[a-z][a-z']*|[.,;!?]", text.lower())
+
+
+def content_terms(text):
+    """Stemmed non-stopword terms of text, in order, without negation cues."""
+    return [stem(token) for token in tokenize(text)
+            if token[0].isalpha() and token not in STOPWORDS and not negation_pattern.fullmatch(token) and not token.endswith("n't")]
+
+
+def negated_terms(text):
+    """
+    Return the frozenset of stemmed terms that fall under a negation cue.
+
+    A cue ("no", "not", "don't", ...) negates up to NEGATION_SCOPE following
+    content terms, stopping early at punctuation or a contrastive conjunction,
+    so "no swelling but wheezing" negates {swell} only.
+    """
+    negated = set()
+    remaining = 0
+    for token in tokenize(text):
+        if negation_pattern.fullmatch(token) or token.endswith("n't"):
+            remaining = NEGATION_SCOPE
+        elif not token[0].isalpha() or token in CLAUSE_BREAKS:
+            remaining = 0
+        elif remaining and token not in STOPWORDS:
+            negated.add(stem(token))
+            remaining -= 1
+    return frozenset(negated)
+
+
+def same_polarity(text, other):
+    """True when both texts negate exactly the same terms (or neither negates anything)."""
+    return negated_terms(text) == negated_terms(other)
+
+
+def embed(text, dimensions=1024):
+    """
+    L2-normalised hashed bag of features: stemmed content terms (weighted 3x),
+    term bigrams and char 3-4-grams of each term. Negated terms are hashed
+    separately ("not:swell") so negation also moves the vector.
+    """
+    vector = np.zeros(dimensions, dtype=np.float32)
+    negated = negated_terms(text)
+    terms = content_terms(text)
+    features = []
+    for term in terms:
+        prefix = "not:" if term in negated else "w:"
+        features += [f"{prefix}{term}"] * 3
+        padded = f" {term} "
+        features += [padded[i:i + n] for n in (3, 4) for i in range(len(padded) - n + 1)]
+    features += [f"b:{a} {b}" for a, b in zip(terms, terms[1:])]
+    for feature in features:
+        vector[zlib.crc32(feature.encode("utf-8")) % dimensions] += 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def similarity(text, other, dimensions=1024):
+    return float(embed(text, dimensions) @ embed(other, dimensions))
+
+
+# Hand-labelled pairs used to pick SEMANTIC_CACHE_THRESHOLD: (text, other, same_verdict).
+# Re-run calibrate() after changing the features above.
+CALIBRATION_PAIRS = [
+    ("lips are swollen", "my lips swelled up", True),
+    ("my lips are swollen", "swollen lips", True),
+    ("my face and lips are swollen", "swelling in my lips and face", True),
+    ("i am wheezing", "i have been wheezing", True),
+    ("wheezing a lot", "lots of wheezing", True),
+    ("i feel short of breath", "shortness of breath", True),
+    ("my chest is tight and i am wheezing", "wheezing with a tight chest", True),
+    ("i feel confused", "i have been confused lately", True),
+    ("my breasts are tender", "breast tenderness", True),
+    ("no symptoms", "no symptoms at all", True),
+    ("i don't have any swelling", "no swelling", True),
+    ("i have shortness of breath when walking", "i have no shortness of breath when walking", False),
+    ("experiencing swelling in my lips and face", "not experiencing swelling in my lips and face", False),
+    ("my lips are swollen", "my lips are not swollen", False),
+    ("i am wheezing", "i am not wheezing", False),
+    ("no swelling but wheezing", "swelling but no wheezing", False),
+    ("lips are swollen", "ankles are swollen", False),
+    ("my lips are swollen", "my tongue is swollen", False),
+    ("i feel confused", "i feel dizzy", False),
+    ("shortness of breath", "chest pain", False),
+    ("breast tenderness", "ankle swelling", False),
+]
+
+
+def calibrate(pairs=CALIBRATION_PAIRS, dimensions=1024):
+    """
+    Return (threshold, scored) where scored lists (similarity, same_verdict,
+    text, other) and threshold is the midpoint of the widest gap between the
+    lowest same-verdict score and the highest different-verdict score among
+    pairs that pass the polarity check. Returns threshold None when the two
+    groups overlap.
+    """
+    scored = [(similarity(a, b, dimensions), same, a, b) for a, b, same in pairs]
+    reachable = [(score, same) for (score, same, a, b) in scored if same_polarity(a, b)]
+    lowest_same = min(score for score, same in reachable if same)
+    highest_different = max((score for score, same in reachable if not same), default=0.0)
+    if lowest_same <= highest_different:
+        return None, scored
+    return round((lowest_same + highest_different) / 2, 2), scored
+
+
+def normalize(user_prompt):
+    return " ".join(str(user_prompt).lower().split()).strip(" .,;!")
+
+
+class SemanticVerdictCache:
+    """
+    Near-duplicate cache of classifier verdicts.
+
+    Symptom texts are embedded locally with embed() and matched by cosine
+    similarity against a fixed-size in-process index. A neighbour is only
+    reused when it negates the same terms as the query, so "no shortness of
+    breath" never inherits the verdict of "shortness of breath". Entries are
+    evicted least-recently-used and persisted to disk as plain text so the
+    index can be rebuilt on load. Whenever a fresh LLM verdict is stored, it is
+    compared with the nearest cached neighbour; these (similarity, agreed) pairs
+    show how accurate each candidate threshold would have been.
+    """
+
+    dimensions = 1024
+    report_floor = 0.6
+
+    def __init__(self, path, threshold, max_entries, audit_rate=0.0):
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        # Fraction of near (non-exact) hits that are still sent to the LLM so the
+        # cached verdict can be checked against a fresh one.
+        self.audit_rate = audit_rate
+        self.vectors = np.zeros((max_entries, self.dimensions), dtype=np.float32)
+        self.entries = OrderedDict()  # (text, is_male) -> {"slot": int, "negated": frozenset, "flags": {label: bool}}
+        self.free_slots = list(range(max_entries - 1, -1, -1))
+        self.slot_keys = [None] * max_entries
+        self.hits = 0
+        self.misses = 0
+        self.polarity_skips = 0
+        self.comparisons = []  # (similarity, agreed)
+        self.disagreements = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def embed(cls, text):
+        return embed(text, cls.dimensions)
+
+    def _neighbours(self, vector, negated, is_male, label):
+        """
+        Yield (similarity, key) for cached entries that know label and negate
+        the same terms, most similar first.
+        """
+        similarities = self.vectors @ vector
+        for slot in np.argsort(-similarities)[:32]:
+            key = self.slot_keys[slot]
+            if key is None or key[1] != bool(is_male) or label not in self.entries[key]["flags"]:
+                continue
+            if self.entries[key]["negated"] != negated:
+                self.polarity_skips += 1
+                continue
+            yield float(similarities[slot]), key
+
+    def lookup(self, user_prompt, is_male, labels):
+        text = normalize(user_prompt)
+        vector = self.embed(text)
+        negated = negated_terms(text)
+        found = {}
+        with self.lock:
+            for label in labels:
+                for similarity, key in self._neighbours(vector, negated, is_male, label):
+                    audited = similarity < 0.9999 and random.random() < self.audit_rate
+                    if similarity >= self.threshold and not audited:
+                        found[label] = self.entries[key]["flags"][label]
+                        self.entries.move_to_end(key)
+                    break
+            self.hits += len(found)
+            self.misses += len(labels) - len(found)
+        return found
+
+    def store(self, user_prompt, is_male, flags):
+        text = normalize(user_prompt)
+        vector = self.embed(text)
+        negated = negated_terms(text)
+        key = (text, bool(is_male))
+        with self.lock:
+            for label, verdict in flags.items():
+                for similarity, neighbour in self._neighbours(vector, negated, is_male, label):
+                    if neighbour != key and similarity >= self.report_floor:
+                        agreed = self.entries[neighbour]["flags"][label] == verdict
+                        self.comparisons.append((similarity, agreed))
+                        if not agreed:
+                            self.disagreements.append({"label": label, "similarity": round(similarity, 3), "text": text, "neighbour": neighbour[0]})
+                    break
+
+            if key in self.entries:
+                self.entries[key]["flags"].update(flags)
+                self.entries.move_to_end(key)
+                return
+            if not self.free_slots:
+                _, evicted = self.entries.popitem(last=False)
+                self.vectors[evicted["slot"]] = 0.0
+                self.slot_keys[evicted["slot"]] = None
+                self.free_slots.append(evicted["slot"])
+            slot = self.free_slots.pop()
+            self.vectors[slot] = vector
+            self.slot_keys[slot] = key
+            self.entries[key] = {"slot": slot, "negated": negated, "flags": dict(flags)}
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            agreement_by_threshold = {}
+            for threshold in (0.6, 0.7, 0.8, 0.85, 0.9, 0.95):
+                compared = [agreed for similarity, agreed in self.comparisons if similarity >= threshold]
+                if compared:
+                    agreement_by_threshold[threshold] = round(sum(compared) / len(compared), 3)
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else None,
+                "entries": len(self.entries),
+                "threshold": self.threshold,
+                "polarity_skips": self.polarity_skips,
+                "comparisons": len(self.comparisons),
+                "agreement_by_threshold": agreement_by_threshold,
+                "disagreements": self.disagreements[-20:],
+            }
+
+    def export_entries(self):
+        """The cached verdicts as plain JSON-able dicts, least recently used first."""
+        with self.lock:
+            return [{"text": text, "is_male": is_male, "flags": dict(entry["flags"])} for (text, is_male), entry in self.entries.items()]
+
+    def merge_entries(self, entries):
+        """Add exported entries (from disk or another process) without counting them as fresh verdicts."""
+        with self.lock:
+            comparisons, disagreements = len(self.comparisons), len(self.disagreements)
+        for entry in entries:
+            self.store(entry["text"], entry["is_male"], entry["flags"])
+        # Known verdicts are not threshold evidence
+        with self.lock:
+            del self.comparisons[comparisons:]
+            del self.disagreements[disagreements:]
+
+    def save(self):
+        entries = self.export_entries()
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "dimensions": self.dimensions, "entries": entries}, f)
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return
+        self.merge_entries(data.get("entries", []))
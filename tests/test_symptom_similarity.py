@@ -0,0 +1,73 @@
+import pytest
+
+from symptom_similarity import CALIBRATION_PAIRS, SemanticVerdictCache, calibrate, negated_terms, same_polarity, similarity
+
+THRESHOLD = 0.85
+
+NEGATED_PAIRS = [
+    ("i have shortness of breath when walking", "i have no shortness of breath when walking"),
+    ("experiencing swelling in my lips and face", "not experiencing swelling in my lips and face"),
+    ("my lips are swollen", "my lips aren't swollen"),
+    ("i am wheezing", "i am not wheezing"),
+    ("no swelling but wheezing", "swelling but no wheezing"),
+]
+
+
+@pytest.mark.parametrize("text, other", NEGATED_PAIRS)
+def test_negated_pairs_differ_in_polarity(text, other):
+    assert not same_polarity(text, other)
+
+
+@pytest.mark.parametrize("text, other", NEGATED_PAIRS)
+def test_negated_pairs_never_share_a_verdict(tmp_path, text, other):
+    cache = SemanticVerdictCache(str(tmp_path / "cache.json"), THRESHOLD, 16)
+    cache.store(text, False, {"angioedema": True, "bronchospasm": True})
+    assert cache.lookup(other, False, ["angioedema", "bronchospasm"]) == {}
+    assert cache.stats()["hits"] == 0
+
+
+def test_negation_scope_stops_at_contrast():
+    assert negated_terms("no swelling but wheezing") == {"swell"}
+    assert negated_terms("i don't have any swelling") == negated_terms("no swelling")
+
+
+def test_paraphrase_reuses_verdict(tmp_path):
+    cache = SemanticVerdictCache(str(tmp_path / "cache.json"), THRESHOLD, 16)
+    cache.store("lips are swollen", False, {"angioedema": True})
+    assert similarity("lips are swollen", "my lips swelled up") >= THRESHOLD
+    assert cache.lookup("My lips swelled up.", False, ["angioedema"]) == {"angioedema": True}
+
+
+def test_different_body_part_misses(tmp_path):
+    cache = SemanticVerdictCache(str(tmp_path / "cache.json"), THRESHOLD, 16)
+    cache.store("my lips are swollen", False, {"angioedema": True})
+    assert cache.lookup("my ankles are swollen", False, ["angioedema"]) == {}
+
+
+def test_default_threshold_separates_calibration_pairs():
+    threshold, scored = calibrate()
+    assert threshold is not None
+    for score, same, text, other in scored:
+        reused = same_polarity(text, other) and score >= THRESHOLD
+        assert reused == same, (text, other, score)
+
+
+def test_save_and_load_keep_polarity(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = SemanticVerdictCache(path, THRESHOLD, 16)
+    cache.store("i am wheezing", False, {"bronchospasm": True})
+    cache.save()
+    reloaded = SemanticVerdictCache(path, THRESHOLD, 16)
+    reloaded.load()
+    assert reloaded.lookup("i am not wheezing", False, ["bronchospasm"]) == {}
+    assert reloaded.lookup("i have been wheezing", False, ["bronchospasm"]) == {"bronchospasm": True}
+
+
+def test_merge_entries_does_not_count_as_evidence(tmp_path):
+    shard = SemanticVerdictCache(str(tmp_path / "shard.json"), THRESHOLD, 16)
+    shard.store("i am wheezing", False, {"bronchospasm": True})
+    parent = SemanticVerdictCache(str(tmp_path / "parent.json"), THRESHOLD, 16)
+    parent.store("i have been wheezing", False, {"bronchospasm": True})
+    parent.merge_entries(shard.export_entries())
+    assert parent.stats()["entries"] == 2
+    assert parent.stats()["comparisons"] == 0
@@ -0,0 +1,104 @@
+"""
+Distill the LLM symptom classifier into a small CPU-only model.
+
+heart_failure_agent.py appends every LLM verdict to symptom_verdicts.jsonl.
+This script fits one char n-gram TF-IDF + logistic regression pipeline per
+contraindication label on those pairs and writes symptom_classifier.pkl, which
+the agent serves with SYMPTOM_CLASSIFIER_BACKEND=distilled.
+
+Each label is exported as the vectorizer's analyzer plus a {ngram: (idf, coef)}
+table and the intercept, so serving is a sparse dot product in plain Python
+(well under a millisecond per label) rather than a full sklearn predict call.
+
+Usage: python train_symptom_classifier.py [--verdicts symptom_verdicts.jsonl] [--output symptom_classifier.pkl]
+"""
+import argparse
+import json
+import pickle
+from datetime import datetime
+
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import cross_val_score
+from sklearn.pipeline import make_pipeline
+
+MIN_EXAMPLES_PER_CLASS = 3
+
+
+def load_verdicts(path):
+    """Return {label: {symptom text: verdict}}; the latest verdict for a text wins."""
+    verdicts = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            # Gynecomastia is only ever asked about male patients
+            if row["label"] == "gynecomastia" and not row["is_male"]:
+                continue
+            verdicts.setdefault(row["label"], {})[row["text"]] = bool(row["verdict"])
+    return verdicts
+
+
+def build_pipeline():
+    return make_pipeline(
+        TfidfVectorizer(analyzer="char_wb", ngram_range=(2, 5), sublinear_tf=True),
+        LogisticRegression(class_weight="balanced", max_iter=1000),
+    )
+
+
+def export_linear_model(pipeline):
+    """Flatten a fitted pipeline into the table scored by distilled_probability()."""
+    vectorizer, classifier = pipeline[0], pipeline[-1]
+    positive = list(classifier.classes_).index(True)
+    coef = classifier.coef_[0] if positive == 1 else -classifier.coef_[0]
+    intercept = classifier.intercept_[0] if positive == 1 else -classifier.intercept_[0]
+    return {
+        "analyzer": vectorizer.build_analyzer(),
+        "weights": {ngram: (float(vectorizer.idf_[j]), float(coef[j])) for ngram, j in vectorizer.vocabulary_.items()},
+        "intercept": float(intercept),
+    }
+
+
+def train(verdicts):
+    models = {}
+    metrics = {}
+    for label, examples in sorted(verdicts.items()):
+        texts = list(examples.keys())
+        targets = list(examples.values())
+        positives = sum(targets)
+        negatives = len(targets) - positives
+        if min(positives, negatives) < MIN_EXAMPLES_PER_CLASS:
+            print(f"{label}: skipped ({positives} positive / {negatives} negative examples)")
+            continue
+
+        folds = min(5, positives, negatives)
+        accuracy = cross_val_score(build_pipeline(), texts, targets, cv=folds).mean()
+
+        models[label] = export_linear_model(build_pipeline().fit(texts, targets))
+        metrics[label] = {
+            "examples": len(texts),
+            "positives": positives,
+            "cv_accuracy": round(float(accuracy), 4),
+        }
+        print(f"{label}: {metrics[label]}")
+    return models, metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--verdicts", default="symptom_verdicts.jsonl")
+    parser.add_argument("--output", default="symptom_classifier.pkl")
+    args = parser.parse_args()
+
+    models, metrics = train(load_verdicts(args.verdicts))
+    if not models:
+        raise SystemExit("Not enough logged verdicts to train any label yet.")
+
+    with open(args.output, "wb") as f:
+        pickle.dump({
+            "models": models,
+            "metrics": metrics,
+            "trained_at": datetime.now().isoformat(),
+        }, f)
+    print(f"Saved distilled symptom classifier to '{args.output}'")